@@ -58,7 +58,8 @@ class PlasmidDataset(Dataset):
 
             val = self.tokenizer(dna)  # val is a list
 
-            dna = torch.tensor(val, dtype=torch.float32)
+            # store the token ids as int64 once, so __getitem__ needs no copy
+            dna = torch.as_tensor(val, dtype=torch.long)
 
             # create the mask, although not using yet.
             mask = torch.full(dna.shape, True)
@@ -84,8 +85,7 @@ class PlasmidDataset(Dataset):
     def __getitem__(self, idx):
         sequence = self.treated_sequences[idx]  # get the sequence
         mask = self.masks[idx]
-        # note: need to make the input into long, so each token wil become a int.
-        sequence = torch.tensor(sequence, dtype=int)
+        # note: the tokens are already stored as long, so each token is an int.
         return (
             sequence,
             mask,
@@ -1,30 +1,37 @@
 # Copyright (c) 2015-present, Facebook, Inc.
 # All rights reserved.
 import os
+import numpy as np
 import torch
 import torch.nn as nn
 from functools import partial
 from torch import Tensor
 from typing import Optional
 import torch.utils.checkpoint as checkpoint
-
-# remember that this is einstein operation, which is the special fancy way of reshaping.
-from einops import rearrange
+from packaging import version
 from timm.models.vision_transformer import _cfg
 from timm.models.registry import register_model
 from timm.models.layers import trunc_normal_
-
-from timm.models.layers import DropPath
 from timm.models.vision_transformer import _load_weights
 
 import math
+import weakref
 
 from mamba_ssm.modules.mamba_simple import Mamba
 
+try:
+    from . import fused_norm
+except ImportError:
+    # loaded as a top-level module, with this directory on sys.path
+    import fused_norm
+
 try:
     from mamba_ssm.ops.triton.layernorm import RMSNorm, layer_norm_fn, rms_norm_fn
 except ImportError:
-    RMSNorm, layer_norm_fn, rms_norm_fn = None, None, None
+    # fall back to our own triton add + RMSNorm kernel, LayerNorm stays unfused
+    RMSNorm, rms_norm_fn = fused_norm.RMSNorm, fused_norm.rms_norm_fn
+
+    layer_norm_fn = None
 
 
 MODEL_PATH = "your_model_path"
@@ -35,6 +42,22 @@ _MODELS = {
 }
 
 
+def _fused_norm_fn(norm):
+    """Returns the fused add + norm kernel matching ``norm``, or None."""
+    if isinstance(norm, RMSNorm):
+        return rms_norm_fn
+    if isinstance(norm, nn.LayerNorm):
+        return layer_norm_fn
+    return None
+
+
+# keep the mamba triton kernels out of torch.compile graphs, tracing them only
+# causes graph breaks and recompilations (a no-op when not compiling)
+@torch.compiler.disable
+def _run_mixer(mixer, hidden_states, inference_params=None):
+    return mixer(hidden_states, inference_params=inference_params)
+
+
 # !mamba block from the repository
 class Block(nn.Module):
     def __init__(
@@ -44,7 +67,6 @@ class Block(nn.Module):
         norm_cls=nn.LayerNorm,
         fused_add_norm=False,
         residual_in_fp32=False,
-        drop_path=0.0,
     ):
         """
         Simple block wrapping a mixer class with LayerNorm/RMSNorm and residual connection"
@@ -57,6 +79,10 @@ class Block(nn.Module):
         the hidden_states (output of the mixer) and the residual.
         This is purely for performance reasons, as we can fuse add and LayerNorm.
         The residual needs to be provided (except for the very first block).
+
+        The add + norm always goes through the fused triton kernel when one exists
+        for the norm class, whatever the value of fused_add_norm.
+        Drop path is sampled by the owning model and passed in as ``keep``.
         """
         super().__init__()
         self.residual_in_fp32 = residual_in_fp32
@@ -66,14 +92,13 @@ class Block(nn.Module):
         self.mixer = mixer_cls(dim)
         self.norm = norm_cls(dim)
 
-        # ! https://stackoverflow.com/questions/69175642/droppath-in-timm-seems-like-a-dropout
-        # ! https://arxiv.org/abs/1603.09382, so they randomly drop some layers
-        self.drop_path = DropPath(drop_path) if drop_path > 0.0 else nn.Identity()
         if self.fused_add_norm:
             assert RMSNorm is not None, "RMSNorm import fails"
             assert isinstance(
                 self.norm, (nn.LayerNorm, RMSNorm)
             ), "Only LayerNorm and RMSNorm are supported for fused_add_norm"
+        # resolve the fused kernel once instead of on every forward
+        self._fused_norm_fn = _fused_norm_fn(self.norm)
 
     def forward(
         self,
@@ -81,28 +106,54 @@ class Block(nn.Module):
         residual: Optional[Tensor] = None,
         inference_params=None,
         use_checkpoint=False,
+        keep: Optional[Tensor] = None,
     ):
         r"""Pass the input through the encoder layer.
 
         Args:
             hidden_states: the sequence to the encoder layer (required).
             residual: hidden_states = Mixer(LN(residual))
+            keep: per-sample drop-path scale of shape [B] (0 or 1 / (1 - p)),
+                applied to hidden_states before the residual add.
         """
-        if not self.fused_add_norm:
+        fused_add_norm_fn = self._fused_norm_fn
+        if residual is None:
+            keep = None
+
+        if keep is not None and isinstance(self.norm, RMSNorm):
+            # fold the drop_path scale into the add + norm, so stochastic depth
+            # costs no extra pass over hidden_states
+            hidden_states, residual = fused_norm.fused_droppath_add_rmsnorm(
+                hidden_states,
+                residual,
+                keep,
+                self.norm.weight,
+                eps=self.norm.eps,
+                prenorm=True,
+                residual_in_fp32=self.residual_in_fp32,
+            )
+        elif fused_add_norm_fn is None:
+            if keep is not None:
+                hidden_states = hidden_states * keep[:, None, None].to(
+                    hidden_states.dtype
+                )
             residual = (
-                (residual + self.drop_path(hidden_states))
-                if residual is not None
-                else hidden_states
+                (residual + hidden_states) if residual is not None else hidden_states
             )
+            # the norm needs its input in its own dtype; this only copies when an fp32
+            # residual meets low precision weights
             hidden_states = self.norm(residual.to(dtype=self.norm.weight.dtype))
+            # a no-op after the first block, where the residual is already fp32
             if self.residual_in_fp32:
                 residual = residual.to(torch.float32)
         else:
-            fused_add_norm_fn = (
-                rms_norm_fn if isinstance(self.norm, RMSNorm) else layer_norm_fn
-            )
+            if keep is not None:
+                hidden_states = hidden_states * keep[:, None, None].to(
+                    hidden_states.dtype
+                )
+            # single pass over the residual stream: add, norm and (optionally) upcast
             hidden_states, residual = fused_add_norm_fn(
-                hidden_states if residual is None else self.drop_path(hidden_states),
+                hidden_states,
                 self.norm.weight,
                 self.norm.bias,
                 residual=residual,
@@ -112,10 +163,14 @@ class Block(nn.Module):
             )
         if use_checkpoint:
             hidden_states = checkpoint.checkpoint(
-                self.mixer, hidden_states, inference_params
+                _run_mixer,
+                self.mixer,
+                hidden_states,
+                inference_params,
+                use_reentrant=False,
             )
         else:
-            hidden_states = self.mixer(hidden_states, inference_params=inference_params)
+            hidden_states = _run_mixer(self.mixer, hidden_states, inference_params)
         return hidden_states, residual
 
     def allocate_inference_cache(self, batch_size, max_seqlen, dtype=None, **kwargs):
@@ -128,9 +183,8 @@ def create_block(
     d_model,
     ssm_cfg=None,
     norm_epsilon=1e-5,
-    drop_path=0.0,
     rms_norm=True,
-    residual_in_fp32=True,
+    residual_in_fp32=False,
     fused_add_norm=True,
     layer_idx=None,
     bimamba=True,
@@ -151,7 +205,6 @@ def create_block(
         d_model,
         mixer_cls,
         norm_cls=norm_cls,
-        drop_path=drop_path,
         fused_add_norm=fused_add_norm,
         residual_in_fp32=residual_in_fp32,
     )
@@ -166,6 +219,7 @@ def _init_weights(
     initializer_range=0.02,  # Now only used for embedding layer.
     rescale_prenorm_residual=True,
     n_residuals_per_layer=1,  # Change to 2 if we have MLP
+    residual_scale=None,  # precomputed sqrt(n_residuals_per_layer * n_layer)
 ):
     if isinstance(module, nn.Linear):
         if module.bias is not None:
@@ -188,8 +242,10 @@ def _init_weights(
                 # We need to reinit p since this code could be called multiple times
                 # Having just p *= scale would repeatedly scale it down
                 nn.init.kaiming_uniform_(p, a=math.sqrt(5))
+                if residual_scale is None:
+                    residual_scale = math.sqrt(n_residuals_per_layer * n_layer)
                 with torch.no_grad():
-                    p /= math.sqrt(n_residuals_per_layer * n_layer)
+                    p /= residual_scale
 
 
 def segm_init_weights(m):
@@ -202,6 +258,14 @@ def segm_init_weights(m):
         nn.init.constant_(m.weight, 1.0)
 
 
+def _full_init(m, n_layer, segm_skip=(), **init_kwargs):
+    # segm init followed by the mamba init, in a single walk over the modules;
+    # modules in segm_skip only get the mamba init
+    if not any(m is skipped for skipped in segm_skip):
+        segm_init_weights(m)
+    _init_weights(m, n_layer=n_layer, **init_kwargs)
+
+
 class Embedding(nn.Module):
     def __init__(self, input_channels, embed_dim):
         super().__init__()
@@ -233,7 +297,9 @@ class VisionMamba(nn.Module):
         initializer_cfg=None,
         fused_add_norm=True,
         rms_norm=True,
-        residual_in_fp32=True,
+        # the fused norms accumulate in fp32 registers, so a bf16 residual stream is
+        # enough and moves half the bytes of an fp32 one
+        residual_in_fp32=False,
         bimamba=True,
         # video
         kernel_size=1,
@@ -244,6 +310,10 @@ class VisionMamba(nn.Module):
         # checkpoint
         use_checkpoint=False,
         checkpoint_num=0,
+        # replay the layer stack from a CUDA graph when no gradients are needed
+        cuda_graphs=False,
+        # torch.compile forward_features, see enable_compile
+        use_compile=False,
     ):
         factory_kwargs = {"device": device, "dtype": dtype}  # follow MambaLMHeadModel
         super().__init__()
@@ -254,6 +324,8 @@ class VisionMamba(nn.Module):
         print(f"Use checkpoint: {use_checkpoint}")
         print(f"Checkpoint number: {checkpoint_num}")
 
+        self.cuda_graphs = cuda_graphs
+
         self.d_model = (
             self.num_features
         ) = self.embed_dim = embed_dim  # num_features for consistency with other models
@@ -265,12 +337,16 @@ class VisionMamba(nn.Module):
 
         self.pos_drop = nn.Dropout(p=drop_rate)
 
-        dpr = [
-            x.item() for x in torch.linspace(0, drop_path_rate, depth)
-        ]  # stochastic depth decay rule
+        # stochastic depth decay rule
+        dpr = np.linspace(0, drop_path_rate, depth).tolist()
         inter_dpr = [0.0] + dpr
-        self.drop_path = (
-            DropPath(drop_path_rate) if drop_path_rate > 0.0 else nn.Identity()
+        self.drop_path_rate = drop_path_rate
+        # rate of every block, plus drop_path_rate for the final add + norm, so that
+        # a single bernoulli call samples the masks of the whole forward
+        self.register_buffer(
+            "drop_path_rates",
+            torch.tensor(inter_dpr[:depth] + [drop_path_rate], dtype=torch.float32),
+            persistent=False,
         )
         # mamba blocks
         # ! THIS IS WHERE It creates the mamba blocks, uses list comprehension to create as many mamba blocks as depth wants.
@@ -285,20 +361,21 @@ class VisionMamba(nn.Module):
                     fused_add_norm=fused_add_norm,
                     layer_idx=i,
                     bimamba=bimamba,
-                    drop_path=inter_dpr[i],
                     **factory_kwargs,
                 )
                 for i in range(depth)
             ]
         )
+        self._ckpt_config = None
+        self._ckpt_ranges = []
+        self._num_checkpointed = 0
 
         # output head
         self.norm_f = (nn.LayerNorm if not rms_norm else RMSNorm)(
             embed_dim, eps=norm_epsilon, **factory_kwargs
         )
+        self._fused_norm_f_fn = _fused_norm_fn(self.norm_f)
 
-        # original init
-        self.apply(segm_init_weights)
         # I am not using the classification head anyways.
         # self.head.apply(segm_init_weights)
 
@@ -313,22 +390,58 @@ class VisionMamba(nn.Module):
         # customized embedding to match the patch embedding
         self.embedding = Embedding(self.output_evo_num_channels, self.embed_dim)
 
-        # mamba init
+        # original (segm) init + mamba init; the embedding was built after the
+        # original segm pass, so it keeps PyTorch's default Linear init
+        initializer_cfg = initializer_cfg if initializer_cfg is not None else {}
+        # the out_proj rescale is the same for every layer, compute it once
+        residual_scale = math.sqrt(
+            initializer_cfg.get("n_residuals_per_layer", 1) * depth
+        )
         self.apply(
             partial(
-                _init_weights,
+                _full_init,
                 n_layer=depth,
-                **(initializer_cfg if initializer_cfg is not None else {}),
+                segm_skip=tuple(self.embedding.modules()),
+                residual_scale=residual_scale,
+                **initializer_cfg,
             )
         )
 
+        self._compile_mode = None
+        if use_compile:
+            self.enable_compile()
+
+    def enable_compile(self, mode="reduce-overhead"):
+        """Compiles forward_features for the fixed (B, num_tokens) input shape.
+
+        Only the mode is stored on the model, the compiled function is shared per
+        mode, so the model still deep-copies and pickles. Calling it again just
+        switches the mode.
+        """
+        if version.parse(torch.__version__) < version.parse("2.2"):
+            raise RuntimeError(
+                f"torch.compile needs PyTorch >= 2.2, found {torch.__version__}"
+            )
+        if self.cuda_graphs:
+            raise ValueError(
+                "cuda_graphs and torch.compile both capture CUDA graphs, "
+                "set cuda_graphs=False before enabling compilation"
+            )
+        self._compile_mode = mode
+
     def allocate_inference_cache(self, batch_size, max_seqlen, dtype=None, **kwargs):
-        return {
-            i: layer.allocate_inference_cache(
-                batch_size, max_seqlen, dtype=dtype, **kwargs
+        # every layer has the same cache layout, so take it from the first one and
+        # back each state with one [depth, ...] tensor; the layers get views of it
+        states = self.layers[0].allocate_inference_cache(
+            batch_size, max_seqlen, dtype=dtype, **kwargs
+        )
+        packed = [
+            torch.zeros(
+                len(self.layers), *state.shape, dtype=state.dtype, device=state.device
             )
-            for i, layer in enumerate(self.layers)
-        }
+            for state in states
+        ]
+        return {i: tuple(state[i] for state in packed) for i in range(len(self.layers))}
 
     @torch.jit.ignore
     def no_weight_decay(self):
@@ -341,12 +454,28 @@ class VisionMamba(nn.Module):
     def load_pretrained(self, checkpoint_path, prefix=""):
         _load_weights(self, checkpoint_path, prefix)
 
+    def _forward_layers(
+        self, start, end, keeps, hidden_states, residual, inference_params=None
+    ):
+        # index the registered layers directly, slicing the ModuleList would build
+        # a new one on every call
+        for i in range(start, end):
+            hidden_states, residual = self.layers[i](
+                hidden_states,
+                residual,
+                inference_params=inference_params,
+                keep=keeps[i],
+            )
+        return hidden_states, residual
+
     def forward_features(self, x, inference_params=None):
         # increasing the number of channels
         # reshape the input, cancel that
         # x = rearrange(x, ' b c t -> (b t) c')
+        if x.dim() == 2:
+            # (b t) c -> b t c as a view, the linear embedding works on the last dim
+            x = x.view(-1, self.sequence_length, x.shape[-1])
         x = self.embedding(x)
-        x = rearrange(x, "(b t) c -> b t c", t=self.sequence_length)
 
         # 16, 64 tokens per sequences, 16 sequences -> 192 channels after,
 
@@ -360,59 +489,194 @@ class VisionMamba(nn.Module):
         # ! Dropout
         x = self.pos_drop(x)
 
+        if (
+            self.cuda_graphs
+            and inference_params is None
+            and not self.use_checkpoint
+            and not torch.is_grad_enabled()
+            and x.is_cuda
+        ):
+            return self._forward_graphed(x)
+        return self._forward_backbone(x, inference_params)
+
+    def _forward_graphed(self, x):
+        """Runs ``_forward_backbone`` by replaying a CUDA graph captured for x.
+
+        The graph lives in _CUDA_GRAPHS rather than on the model, so the model
+        still deep-copies and pickles after a graphed call.
+        """
+        signature = (
+            x.shape,
+            x.dtype,
+            x.device,
+            self.training,
+            torch.is_autocast_enabled(),
+        )
+        cached = _CUDA_GRAPHS.get(self)
+        if cached is None or cached[0] != signature:
+            graph_in = x.clone()
+            # warm up on a side stream so lazy initialization is not captured
+            stream = torch.cuda.Stream(device=x.device)
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                self._forward_backbone(graph_in)
+            torch.cuda.current_stream().wait_stream(stream)
+
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph):
+                graph_out = self._forward_backbone(graph_in)
+            cached = _CUDA_GRAPHS[self] = (signature, graph, graph_in, graph_out)
+
+        _, graph, graph_in, graph_out = cached
+        graph_in.copy_(x)
+        graph.replay()
+        return graph_out.clone()
+
+    def _forward_backbone(self, x, inference_params=None):
+        # one drop-path scale per sample for every layer and for the final norm
+        if self.training and self.drop_path_rate > 0.0:
+            keeps = self._sample_keeps(x.shape[0]).unbind(1)
+        else:
+            keeps = (None,) * (len(self.layers) + 1)
+
         # mamba impl
         residual = None
         hidden_states = x
-        for idx, layer in enumerate(self.layers):
-            # ! This might be useful if we have to go through pretraining (i.e. if we run the model first on some other data)
-            if self.use_checkpoint and idx < self.checkpoint_num:
-                hidden_states, residual = layer(
-                    hidden_states,
-                    residual,
-                    inference_params=inference_params,
-                    use_checkpoint=True,
-                )
-            # ! hidden state and residual are other parts of the state space model.s
-            else:
-                hidden_states, residual = layer(
-                    hidden_states, residual, inference_params=inference_params
-                )
-
-        if not self.fused_add_norm:
-            if residual is None:
-                residual = hidden_states
-            else:
-                residual = residual + self.drop_path(hidden_states)
-            hidden_states = self.norm_f(residual.to(dtype=self.norm_f.weight.dtype))
-        else:
-            # Set prenorm=False here since we don't need the residual
-            fused_add_norm_fn = (
-                rms_norm_fn if isinstance(self.norm_f, RMSNorm) else layer_norm_fn
+        # ! This might be useful if we have to go through pretraining (i.e. if we run the model first on some other data)
+        # only the segment inputs are saved for backward
+        ckpt_ranges, num_checkpointed = self._checkpoint_ranges()
+        for start, end in ckpt_ranges:
+            hidden_states, residual = checkpoint.checkpoint(
+                self._forward_layers,
+                start,
+                end,
+                keeps,
+                hidden_states,
+                residual,
+                inference_params,
+                use_reentrant=False,
             )
-            hidden_states = fused_add_norm_fn(
-                self.drop_path(hidden_states),
+        # ! hidden state and residual are other parts of the state space model.s
+        hidden_states, residual = self._forward_layers(
+            num_checkpointed,
+            len(self.layers),
+            keeps,
+            hidden_states,
+            residual,
+            inference_params,
+        )
+
+        keep = keeps[-1] if residual is not None else None
+        fused_add_norm_fn = self._fused_norm_f_fn
+        if keep is not None and isinstance(self.norm_f, RMSNorm):
+            # drop_path + add + norm_f as one pass, the per-sample mask is folded
+            # in as a row scale
+            hidden_states = fused_norm.fused_droppath_add_rmsnorm(
+                hidden_states,
+                residual,
+                keep,
                 self.norm_f.weight,
-                self.norm_f.bias,
                 eps=self.norm_f.eps,
-                residual=residual,
-                prenorm=False,
                 residual_in_fp32=self.residual_in_fp32,
             )
+        else:
+            if keep is not None:
+                hidden_states = hidden_states * keep[:, None, None].to(
+                    hidden_states.dtype
+                )
+            if fused_add_norm_fn is None:
+                if residual is None:
+                    residual = hidden_states
+                else:
+                    residual = residual + hidden_states
+                hidden_states = self.norm_f(residual.to(dtype=self.norm_f.weight.dtype))
+            else:
+                # Set prenorm=False here since we don't need the residual
+                hidden_states = fused_add_norm_fn(
+                    hidden_states,
+                    self.norm_f.weight,
+                    self.norm_f.bias,
+                    eps=self.norm_f.eps,
+                    residual=residual,
+                    prenorm=False,
+                    residual_in_fp32=self.residual_in_fp32,
+                )
 
         return hidden_states
 
+    def _checkpoint_ranges(self):
+        """Index ranges of ~4 layers that run under one checkpoint each.
+
+        Recomputed only when use_checkpoint, checkpoint_num or the depth change.
+        Returns the ranges and the number of checkpointed layers.
+        """
+        config = (self.use_checkpoint, self.checkpoint_num, len(self.layers))
+        if config != self._ckpt_config:
+            num_checkpointed = 0
+            if self.use_checkpoint:
+                num_checkpointed = min(self.checkpoint_num, len(self.layers))
+            self._ckpt_ranges = []
+            if num_checkpointed > 0:
+                num_segments = max(1, num_checkpointed // 4)
+                segment_size = math.ceil(num_checkpointed / num_segments)
+                for start in range(0, num_checkpointed, segment_size):
+                    end = min(start + segment_size, num_checkpointed)
+                    self._ckpt_ranges.append((start, end))
+            self._num_checkpointed = num_checkpointed
+            self._ckpt_config = config
+        return self._ckpt_ranges, self._num_checkpointed
+
+    def _sample_keeps(self, batch_size):
+        """Drop-path scales of shape [B, depth + 1], either 0 or 1 / (1 - p)."""
+        keep_prob = 1.0 - self.drop_path_rates
+        keeps = torch.bernoulli(keep_prob.expand(batch_size, -1))
+        return keeps.div_(keep_prob.clamp_min(1e-8))
+
     # !then you can run forward here, to change the features of the forward inference parameter
     def forward(self, x, inference_params=None):
-        x = self.forward_features(x, inference_params)
+        """
+        Args:
+            x: evo features of shape (B, T, output_evo_num_channels), or flattened
+                to (B * T, output_evo_num_channels) with T == num_tokens.
+
+        Returns:
+            the normalized hidden states, of shape (B, T, embed_dim).
+        """
+        if self._compile_mode is not None:
+            forward_features = _compiled_forward_features(self._compile_mode)
+            x = forward_features(self, x, inference_params)
+        else:
+            x = self.forward_features(x, inference_params)
 
         return x
 
 
+_COMPILED_FORWARD_FEATURES = {}
+# captured CUDA graph per model, dropped together with the model
+_CUDA_GRAPHS = weakref.WeakKeyDictionary()
+
+
+def _compiled_forward_features(mode):
+    if mode not in _COMPILED_FORWARD_FEATURES:
+        _COMPILED_FORWARD_FEATURES[mode] = torch.compile(
+            VisionMamba.forward_features, mode=mode, dynamic=False, fullgraph=False
+        )
+    return _COMPILED_FORWARD_FEATURES[mode]
+
+
 def inflate_weight(weight_2d, time_dim, center=True):
     print(f"Init center: {center}")
     if center:
-        weight_3d = torch.zeros(*weight_2d.shape)
-        weight_3d = weight_3d.unsqueeze(2).repeat(1, 1, time_dim, 1, 1)
+        C_out, C_in, H, W = weight_2d.shape
+        weight_3d = torch.zeros(
+            C_out,
+            C_in,
+            time_dim,
+            H,
+            W,
+            dtype=weight_2d.dtype,
+            device=weight_2d.device,
+        )
         middle_idx = time_dim // 2
         weight_3d[:, :, middle_idx, :, :] = weight_2d
     else:
@@ -447,7 +711,6 @@ def videomamba_tiny(pretrained=False, **kwargs):
         # depth=24,
         depth=12,  # this is what causes the increase in mempry usage.
         rms_norm=True,
-        residual_in_fp32=True,
         fused_add_norm=True,
         # num_frames=16,
         **kwargs,  # this will include the arguments that I passed into videomamba_tiny
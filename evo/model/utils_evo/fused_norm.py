@@ -0,0 +1,280 @@
+# Fused residual-add + RMSNorm (forward and backward), used by VideoMamba when the
+# mamba_ssm triton layernorm kernels are not available.
+import torch
+import torch.nn as nn
+import triton
+import triton.language as tl
+
+
+@triton.jit
+def _fused_add_rmsnorm_fwd(
+    X,  # input, (M, N)
+    RESIDUAL,  # residual, (M, N)
+    KEEP,  # per-sample drop-path scale, (M // rows_per_sample,)
+    W,  # weight, (N,)
+    Y,  # normalized output, (M, N)
+    RESIDUAL_OUT,  # x + residual, (M, N)
+    RSTD,  # 1 / rms per row, (M,)
+    stride_x_row,
+    stride_res_row,
+    stride_y_row,
+    stride_res_out_row,
+    N,
+    rows_per_sample,
+    eps,
+    HAS_RESIDUAL: tl.constexpr,
+    HAS_KEEP: tl.constexpr,
+    BLOCK_N: tl.constexpr,
+):
+    # one program per row
+    row = tl.program_id(0)
+    cols = tl.arange(0, BLOCK_N)
+    mask = cols < N
+
+    x = tl.load(X + row * stride_x_row + cols, mask=mask, other=0.0).to(tl.float32)
+    if HAS_KEEP:
+        x *= tl.load(KEEP + row // rows_per_sample)
+    if HAS_RESIDUAL:
+        res = tl.load(RESIDUAL + row * stride_res_row + cols, mask=mask, other=0.0)
+        x += res.to(tl.float32)
+    tl.store(RESIDUAL_OUT + row * stride_res_out_row + cols, x, mask=mask)
+
+    var = tl.sum(x * x, axis=0) / N
+    rstd = 1 / tl.sqrt(var + eps)
+    tl.store(RSTD + row, rstd)
+
+    w = tl.load(W + cols, mask=mask).to(tl.float32)
+    y = x * rstd * w
+    tl.store(Y + row * stride_y_row + cols, y, mask=mask)
+
+
+@triton.jit
+def _fused_add_rmsnorm_bwd(
+    RESIDUAL_OUT,  # x + residual saved by the forward, (M, N)
+    W,  # weight, (N,)
+    RSTD,  # 1 / rms per row, (M,)
+    KEEP,  # per-sample drop-path scale, (M // rows_per_sample,)
+    DY,  # grad of the normalized output, (M, N)
+    DRESIDUAL_OUT,  # grad of the residual output, (M, N)
+    DX,  # grad of x, (M, N)
+    DRESIDUAL,  # grad of the residual input, (M, N)
+    DW,  # per-program partial grads of the weight, (num_programs, N)
+    stride_res_out_row,
+    stride_dy_row,
+    stride_dres_out_row,
+    stride_dx_row,
+    stride_dres_row,
+    M,
+    N,
+    rows_per_sample,
+    rows_per_program,
+    HAS_DRESIDUAL: tl.constexpr,
+    HAS_KEEP: tl.constexpr,
+    BLOCK_N: tl.constexpr,
+):
+    # each program handles a block of rows and accumulates dw in registers
+    program = tl.program_id(0)
+    row_start = program * rows_per_program
+    row_end = min(row_start + rows_per_program, M)
+    cols = tl.arange(0, BLOCK_N)
+    mask = cols < N
+
+    w = tl.load(W + cols, mask=mask, other=0.0).to(tl.float32)
+    dw = tl.zeros((BLOCK_N,), dtype=tl.float32)
+    for row in range(row_start, row_end):
+        # recompute the normalized input from the saved rstd instead of storing it
+        x = tl.load(
+            RESIDUAL_OUT + row * stride_res_out_row + cols, mask=mask, other=0.0
+        ).to(tl.float32)
+        rstd = tl.load(RSTD + row)
+        x_hat = x * rstd
+        dy = tl.load(DY + row * stride_dy_row + cols, mask=mask, other=0.0).to(
+            tl.float32
+        )
+        dw += dy * x_hat
+
+        wdy = w * dy
+        c = tl.sum(x_hat * wdy, axis=0) / N
+        dx = (wdy - x_hat * c) * rstd
+        dx += tl.load(
+            DRESIDUAL_OUT + row * stride_dres_out_row + cols, mask=mask, other=0.0
+        ).to(tl.float32)
+        if HAS_DRESIDUAL:
+            tl.store(DRESIDUAL + row * stride_dres_row + cols, dx, mask=mask)
+        if HAS_KEEP:
+            dx *= tl.load(KEEP + row // rows_per_sample)
+        tl.store(DX + row * stride_dx_row + cols, dx, mask=mask)
+
+    tl.store(DW + program * N + cols, dw, mask=mask)
+
+
+class FusedAddRMSNormFn(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, residual, keep, weight, eps, residual_in_fp32):
+        x_shape = x.shape
+        N = x_shape[-1]
+        x = x.reshape(-1, N)
+        if x.stride(-1) != 1:
+            x = x.contiguous()
+        if residual is not None:
+            residual = residual.reshape(-1, N)
+            if residual.stride(-1) != 1:
+                residual = residual.contiguous()
+        weight = weight.contiguous()
+        if keep is not None:
+            keep = keep.reshape(-1).float().contiguous()
+
+        residual_dtype = (
+            torch.float32
+            if residual_in_fp32
+            else (residual.dtype if residual is not None else x.dtype)
+        )
+        M = x.shape[0]
+        y = torch.empty_like(x)
+        residual_out = torch.empty(M, N, dtype=residual_dtype, device=x.device)
+        rstd = torch.empty(M, dtype=torch.float32, device=x.device)
+        rows_per_sample = M // keep.shape[0] if keep is not None else M
+
+        BLOCK_N = triton.next_power_of_2(N)
+        _fused_add_rmsnorm_fwd[(M,)](
+            x,
+            residual,
+            keep,
+            weight,
+            y,
+            residual_out,
+            rstd,
+            x.stride(0),
+            residual.stride(0) if residual is not None else 0,
+            y.stride(0),
+            residual_out.stride(0),
+            N,
+            rows_per_sample,
+            eps,
+            HAS_RESIDUAL=residual is not None,
+            HAS_KEEP=keep is not None,
+            BLOCK_N=BLOCK_N,
+        )
+
+        ctx.save_for_backward(residual_out, weight, rstd, keep)
+        ctx.rows_per_sample = rows_per_sample
+        ctx.x_shape = x_shape
+        ctx.x_dtype = x.dtype
+        ctx.residual_dtype = residual.dtype if residual is not None else None
+        return y.reshape(x_shape), residual_out.reshape(x_shape)
+
+    @staticmethod
+    def backward(ctx, dy, dresidual_out):
+        residual_out, weight, rstd, keep = ctx.saved_tensors
+        M, N = residual_out.shape
+        dy = dy.reshape(-1, N)
+        if dy.stride(-1) != 1:
+            dy = dy.contiguous()
+        dresidual_out = dresidual_out.reshape(-1, N)
+        if dresidual_out.stride(-1) != 1:
+            dresidual_out = dresidual_out.contiguous()
+
+        has_residual = ctx.residual_dtype is not None
+        dx = torch.empty(M, N, dtype=ctx.x_dtype, device=dy.device)
+        dresidual = (
+            torch.empty(M, N, dtype=ctx.residual_dtype, device=dy.device)
+            if has_residual
+            else None
+        )
+
+        # one program per SM, each reducing its rows' share of dw in registers
+        sm_count = torch.cuda.get_device_properties(dy.device).multi_processor_count
+        rows_per_program = max(1, triton.cdiv(M, sm_count))
+        num_programs = triton.cdiv(M, rows_per_program)
+        dw_partial = torch.empty(num_programs, N, dtype=torch.float32, device=dy.device)
+
+        _fused_add_rmsnorm_bwd[(num_programs,)](
+            residual_out,
+            weight,
+            rstd,
+            keep,
+            dy,
+            dresidual_out,
+            dx,
+            dresidual,
+            dw_partial,
+            residual_out.stride(0),
+            dy.stride(0),
+            dresidual_out.stride(0),
+            dx.stride(0),
+            dresidual.stride(0) if has_residual else 0,
+            M,
+            N,
+            ctx.rows_per_sample,
+            rows_per_program,
+            HAS_DRESIDUAL=has_residual,
+            HAS_KEEP=keep is not None,
+            BLOCK_N=triton.next_power_of_2(N),
+        )
+
+        dw = dw_partial.sum(0).to(weight.dtype)
+        dx = dx.reshape(ctx.x_shape)
+        if has_residual:
+            dresidual = dresidual.reshape(ctx.x_shape)
+        return dx, dresidual, None, dw, None, None
+
+
+def fused_add_rmsnorm(x, residual, weight, eps=1e-6, residual_in_fp32=False):
+    """Computes ``residual = x + residual`` and ``RMSNorm(residual)`` in one pass.
+
+    Returns (normalized, residual). The add and the reduction are done in fp32
+    registers regardless of the input dtypes.
+    """
+    return FusedAddRMSNormFn.apply(x, residual, None, weight, eps, residual_in_fp32)
+
+
+def fused_droppath_add_rmsnorm(
+    x, residual, keep, weight, eps=1e-6, prenorm=False, residual_in_fp32=False
+):
+    """Computes ``RMSNorm(x * keep + residual)`` in one pass.
+
+    ``keep`` holds one drop-path scale per sample (shape ``[B]`` or ``[B, 1, 1]``,
+    already divided by the keep probability), so stochastic depth costs no extra
+    pass over ``x``.
+    """
+    out, residual = FusedAddRMSNormFn.apply(
+        x, residual, keep, weight, eps, residual_in_fp32
+    )
+    return (out, residual) if prenorm else out
+
+
+def rms_norm_fn(
+    x,
+    weight,
+    bias,
+    residual=None,
+    prenorm=False,
+    residual_in_fp32=False,
+    eps=1e-6,
+):
+    """Drop-in for ``mamba_ssm.ops.triton.layernorm.rms_norm_fn``."""
+    assert bias is None, "RMSNorm has no bias"
+    out, residual = fused_add_rmsnorm(
+        x, residual, weight, eps=eps, residual_in_fp32=residual_in_fp32
+    )
+    return (out, residual) if prenorm else out
+
+
+class RMSNorm(nn.Module):
+    def __init__(self, hidden_size, eps=1e-5, device=None, dtype=None):
+        factory_kwargs = {"device": device, "dtype": dtype}
+        super().__init__()
+        self.eps = eps
+        self.weight = nn.Parameter(torch.ones(hidden_size, **factory_kwargs))
+        self.register_parameter("bias", None)
+
+    def forward(self, x, residual=None, prenorm=False, residual_in_fp32=False):
+        return rms_norm_fn(
+            x,
+            self.weight,
+            self.bias,
+            residual=residual,
+            prenorm=prenorm,
+            residual_in_fp32=residual_in_fp32,
+            eps=self.eps,
+        )
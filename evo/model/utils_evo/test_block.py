@@ -0,0 +1,35 @@
+import pytest
+import torch
+import torch.nn as nn
+
+pytest.importorskip("timm")
+pytest.importorskip("mamba_ssm")
+
+from VideoMamba import Block
+
+
+class IdentityMixer(nn.Module):
+    def forward(self, hidden_states, inference_params=None):
+        return hidden_states
+
+
+@pytest.mark.parametrize("dtype", [torch.float16, torch.bfloat16])
+def test_unfused_norm_with_fp32_residual(dtype):
+    dim = 32
+    block = Block(
+        dim,
+        lambda dim: IdentityMixer(),
+        norm_cls=nn.LayerNorm,
+        residual_in_fp32=True,
+    ).to(dtype)
+    # take the unfused branch, as when layer_norm_fn could not be imported
+    block._fused_norm_fn = None
+
+    hidden_states = torch.randn(2, 8, dim, dtype=dtype)
+    hidden_states, residual = block(hidden_states)
+    assert residual.dtype == torch.float32
+
+    # second block: fp32 residual stream, low precision norm weights
+    hidden_states, residual = block(hidden_states, residual)
+    assert hidden_states.dtype == dtype
+    assert residual.dtype == torch.float32
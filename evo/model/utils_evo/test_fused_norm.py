@@ -0,0 +1,103 @@
+import pytest
+import torch
+
+pytest.importorskip("triton")
+if not torch.cuda.is_available():
+    pytest.skip("the fused norm kernels need a GPU", allow_module_level=True)
+
+from fused_norm import fused_add_rmsnorm, fused_droppath_add_rmsnorm
+
+EPS = 1e-5
+TOLERANCES = {
+    torch.float32: dict(atol=1e-4, rtol=1e-4),
+    torch.bfloat16: dict(atol=3e-2, rtol=3e-2),
+}
+
+
+def reference_droppath_add_rmsnorm(x, residual, keep, weight, eps, residual_in_fp32):
+    """Eager RMSNorm(x * keep + residual), computed in fp32 like the kernel."""
+    h = x.float()
+    if keep is not None:
+        h = h * keep.float().view(-1, *([1] * (x.dim() - 1)))
+    if residual is not None:
+        h = h + residual.float()
+    if residual_in_fp32:
+        residual_dtype = torch.float32
+    else:
+        residual_dtype = residual.dtype if residual is not None else x.dtype
+    out = h * torch.rsqrt(h.pow(2).mean(-1, keepdim=True) + eps) * weight.float()
+    return out.to(x.dtype), h.to(residual_dtype)
+
+
+def _inputs(dtype, has_residual=True, has_keep=True):
+    torch.manual_seed(0)
+    B, T, N = 3, 17, 96  # N is not a power of two, to exercise the column mask
+    x = torch.randn(B, T, N, device="cuda", dtype=dtype, requires_grad=True)
+    residual = (
+        torch.randn(B, T, N, device="cuda", dtype=dtype, requires_grad=True)
+        if has_residual
+        else None
+    )
+    weight = torch.randn(N, device="cuda", dtype=dtype, requires_grad=True)
+    keep = (
+        torch.tensor([0.0, 2.0, 2.0], device="cuda")  # drop-path with p = 0.5
+        if has_keep
+        else None
+    )
+    return x, residual, keep, weight
+
+
+def _check(fused_fn, x, residual, keep, weight, residual_in_fp32):
+    tol = TOLERANCES[x.dtype]
+    leaves = [t for t in (x, residual, weight) if t is not None]
+
+    out, res_out = fused_fn(x, residual, keep, weight, EPS, residual_in_fp32)
+    ref_out, ref_res_out = reference_droppath_add_rmsnorm(
+        x, residual, keep, weight, EPS, residual_in_fp32
+    )
+    assert out.dtype == ref_out.dtype and res_out.dtype == ref_res_out.dtype
+    torch.testing.assert_close(out, ref_out, **tol)
+    torch.testing.assert_close(res_out, ref_res_out, **tol)
+
+    # gradients through both outputs, as in a prenorm block
+    d_out, d_res = torch.randn_like(out), torch.randn_like(res_out)
+    grads = torch.autograd.grad((out * d_out).sum() + (res_out * d_res).sum(), leaves)
+    ref_grads = torch.autograd.grad(
+        (ref_out * d_out).sum() + (ref_res_out * d_res).sum(), leaves
+    )
+    for grad, ref_grad in zip(grads, ref_grads):
+        assert grad.dtype == ref_grad.dtype
+        torch.testing.assert_close(grad, ref_grad, **tol)
+
+
+def _droppath_fn(x, residual, keep, weight, eps, residual_in_fp32):
+    return fused_droppath_add_rmsnorm(
+        x,
+        residual,
+        keep,
+        weight,
+        eps=eps,
+        prenorm=True,
+        residual_in_fp32=residual_in_fp32,
+    )
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16])
+@pytest.mark.parametrize("has_keep", [False, True])
+@pytest.mark.parametrize("residual_in_fp32", [False, True])
+def test_fused_droppath_add_rmsnorm(dtype, has_keep, residual_in_fp32):
+    x, residual, keep, weight = _inputs(dtype, has_keep=has_keep)
+    _check(_droppath_fn, x, residual, keep, weight, residual_in_fp32)
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16])
+@pytest.mark.parametrize("residual_in_fp32", [False, True])
+def test_fused_add_rmsnorm_without_residual(dtype, residual_in_fp32):
+    x, residual, keep, weight = _inputs(dtype, has_residual=False, has_keep=False)
+
+    def fused_fn(x, residual, keep, weight, eps, residual_in_fp32):
+        return fused_add_rmsnorm(
+            x, residual, weight, eps=eps, residual_in_fp32=residual_in_fp32
+        )
+
+    _check(fused_fn, x, residual, keep, weight, residual_in_fp32)
@@ -1,5 +1,6 @@
-from typing import Optional, Dict, List
+from typing import Optional, Dict
 
+import numpy as np
 import torch
 from transformers import PreTrainedTokenizerFast
 
@@ -21,6 +22,17 @@ LETTER_TO_BASES: Dict[str, str] = {
     "Y": "CT",
 }
 
+# Lookup tables indexed by the ASCII code of a (upper or lower case) letter:
+# the ASCII codes of the bases it may stand for, and how many there are.
+LETTER_CHOICES: np.ndarray = np.zeros((256, 4), dtype=np.uint8)
+LETTER_NUM_CHOICES: np.ndarray = np.zeros(256, dtype=np.int64)
+for _letter, _bases in LETTER_TO_BASES.items():
+    for _code in (ord(_letter), ord(_letter.lower())):
+        LETTER_CHOICES[_code, : len(_bases)] = np.frombuffer(
+            _bases.encode("ascii"), dtype=np.uint8
+        )
+        LETTER_NUM_CHOICES[_code] = len(_bases)
+
 
 class DNATokenizer(PreTrainedTokenizerFast):
     """
@@ -63,12 +75,14 @@ class DNATokenizer(PreTrainedTokenizerFast):
         Returns:
             torch.Tensor: A tensor of token IDs representing the DNA sequence.
         """
-        bases: List[str] = []
-        for x in dna:
-            choices = LETTER_TO_BASES[x.upper()]
-            i = torch.randint(len(choices), size=[1]).item()
-            bases.append(choices[i])
-        dna = "".join(bases)
+        codes = np.frombuffer(dna.encode("ascii"), dtype=np.uint8)
+        num_choices = LETTER_NUM_CHOICES[codes]
+        if not num_choices.all():
+            raise KeyError(chr(codes[num_choices == 0][0]).upper())
+
+        # 12 is divisible by 1, 2, 3 and 4, so the modulo picks uniformly
+        i = torch.randint(12, size=[len(codes)]).numpy() % num_choices
+        dna = LETTER_CHOICES[codes, i].tobytes().decode("ascii")
 
         if max_length is None:
             truncation = False
@@ -233,4 +233,5 @@ class LitLLM(pl.LightningModule):
             repetition_penalty=hp.repetition_penalty,
             vocab_size=len(self.tokenizer),
         )
+        samples = samples.cpu()  # one device-to-host copy for the whole batch
         return [self.tokenizer.decode_dna(x) for x in samples]
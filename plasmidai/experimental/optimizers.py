@@ -1,4 +1,4 @@
-from typing import Callable, List, Tuple, Any, Optional
+from typing import Callable, Dict, List, Tuple, Any, Optional
 
 import torch
 import torch.nn as nn
@@ -23,7 +23,9 @@ def build_optimizer_and_scheduler(
     Build an AdamW optimizer and a LambdaLR scheduler for a given model.
 
     This function separates parameters that require weight decay from those that don't,
-    and creates an optimizer and scheduler accordingly.
+    and creates an optimizer and scheduler accordingly. Unless `fused` or `foreach` is
+    passed explicitly, the fused CUDA implementation of AdamW is used when all
+    parameters live on the GPU, and the multi-tensor (foreach) one otherwise.
 
     Args:
         model (nn.Module): The model whose parameters are to be optimized.
@@ -38,15 +40,16 @@ def build_optimizer_and_scheduler(
     params: List[torch.Tensor] = []
     params_no_wd: List[torch.Tensor] = []
 
-    for name, p in model.named_parameters():
+    # Map each parameter to its parent module in a single pass over the tree
+    param_to_parent: Dict[int, Tuple[nn.Module, str]] = {}
+    for module in model.modules():
+        for name, p in module.named_parameters(recurse=False):
+            param_to_parent.setdefault(id(p), (module, name))
+
+    for p in model.parameters():
         if not p.requires_grad:
             continue
-        *attrs, name = name.split(".")
-
-        # Get parent module
-        parent: nn.Module = model
-        for k in attrs:
-            parent = getattr(parent, k)
+        parent, name = param_to_parent[id(p)]
 
         # Bucket parameters depending on whether they need weight decay
         if isinstance(parent, (nn.LayerNorm, RMSNorm)) or (name == "bias"):
@@ -56,15 +59,33 @@ def build_optimizer_and_scheduler(
         else:
             params.append(p)
 
-    optimizer: Optimizer = torch.optim.AdamW(
-        params=[
-            {"params": params, "weight_decay": wd},
-            {"params": params_no_wd, "weight_decay": 0.0},
-        ],
-        lr=1.0,
-        betas=betas,
-        **optim_kwargs,
-    )
+    param_groups = [
+        {"params": params, "weight_decay": wd},
+        {"params": params_no_wd, "weight_decay": 0.0},
+    ]
+
+    # Prefer the single-kernel fused AdamW on CUDA, else the multi-tensor path
+    auto_fused = False
+    if "fused" not in optim_kwargs and "foreach" not in optim_kwargs:
+        if all(p.is_cuda for p in params + params_no_wd):
+            optim_kwargs["fused"] = auto_fused = True
+        else:
+            optim_kwargs["foreach"] = True
+
+    try:
+        optimizer: Optimizer = torch.optim.AdamW(
+            params=param_groups, lr=1.0, betas=betas, **optim_kwargs
+        )
+    except (TypeError, RuntimeError):
+        # An explicit fused=True from the caller should fail loudly
+        if not auto_fused:
+            raise
+        # Older PyTorch or unsupported parameters for the fused kernel
+        del optim_kwargs["fused"]
+        optim_kwargs["foreach"] = True
+        optimizer = torch.optim.AdamW(
+            params=param_groups, lr=1.0, betas=betas, **optim_kwargs
+        )
 
     scheduler: LambdaLR = torch.optim.lr_scheduler.LambdaLR(optimizer, lr_lambda=lr)
     return optimizer, scheduler
@@ -41,7 +41,8 @@ def random_circular_crop(dna: str, L: int) -> str:
     Raises:
         AssertionError: If the length of the cropped sequence doesn't match L.
     """
-    start: int = torch.randint(len(dna), size=[1]).item()
+    # Draw on the CPU generator so .item() never syncs with a CUDA default device
+    start: int = torch.randint(len(dna), size=[1], device="cpu").item()
     L = min(len(dna), L)
     crop: str = dna[start : (start + L)]
     overhang: int = L - len(crop)  # wrap around to start